@@ -2,6 +2,203 @@ import shutil
 import os
 import sys
 import json
+import glob
+import re
+import hashlib
+import subprocess
+import threading
+import ctypes
+from concurrent.futures import ThreadPoolExecutor
+
+if os.name == 'nt':
+  from ctypes import wintypes
+  kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+  kernel32.CopyFileW.argtypes = (wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.BOOL)
+  kernel32.CopyFileW.restype = wintypes.BOOL
+  kernel32.CopyFileExW.argtypes = (wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, wintypes.DWORD)
+  kernel32.CopyFileExW.restype = wintypes.BOOL
+  shell32 = ctypes.WinDLL("shell32")
+  shell32.SHCreateDirectoryExW.argtypes = (wintypes.HWND, wintypes.LPCWSTR, ctypes.c_void_p)
+  shell32.SHCreateDirectoryExW.restype = ctypes.c_int
+
+# CopyFileExW flag that bypasses the file system cache (Windows 8+)
+COPY_FILE_NO_BUFFERING = 0x00001000
+
+# Files larger than this are copied unbuffered. Unbuffered I/O needs aligned
+# transfers, which only pays off for large files such as the native DLLs.
+UNBUFFERED_COPY_THRESHOLD = 4 * 1024 * 1024
+
+# Copying is I/O bound, so use more threads than cores to keep several copies in flight
+COPY_WORKERS = min(32, (os.cpu_count() or 4) * 4)
+
+# print() writes the message and the newline separately, so output from
+# concurrent deploys is serialized to keep lines from interleaving
+printLock = threading.Lock()
+
+def log(message):
+  with printLock:
+    print(message)
+
+# Copy a file with the native Win32 CopyFileW, which copies data, attributes
+# and timestamps without going through Python read/write calls. Large files
+# are copied with CopyFileExW and COPY_FILE_NO_BUFFERING so they do not churn
+# the file system cache. Pass size when it is already known to save a stat.
+def win_copy_file(src, dst, size=None):
+  if size is None:
+    size = os.path.getsize(src)
+  if size > UNBUFFERED_COPY_THRESHOLD:
+    copied = kernel32.CopyFileExW(src, dst, None, None, None, COPY_FILE_NO_BUFFERING)
+  else:
+    copied = kernel32.CopyFileW(src, dst, False)
+  if not copied:
+    raise ctypes.WinError(ctypes.get_last_error())
+
+# Copy a single file's data. On Windows this uses CopyFileW. Elsewhere
+# shutil.copyfile already picks the fastest path (os.sendfile on Linux,
+# fcopyfile on macOS). File metadata is not needed for a deployed package,
+# so unlike shutil.copy2 there is no extra copystat per file.
+# dst must be the full target file path, not a folder. size is optional; when
+# known it saves a stat on Windows and is ignored elsewhere.
+def copy_file(src, dst, size=None):
+  if os.name == 'nt':
+    win_copy_file(src, dst, size)
+  else:
+    shutil.copyfile(src, dst)
+
+# Results of SHCreateDirectoryExW that mean the folder is there
+CREATE_DIRECTORY_OK = (0, 80, 183) # ERROR_SUCCESS, ERROR_FILE_EXISTS, ERROR_ALREADY_EXISTS
+
+# Create a package subfolder and any missing parents, like os.makedirs(path, exist_ok=True).
+# On Windows SHCreateDirectoryExW creates the whole chain in one call. It also
+# reports success when a file has that name, so the result is checked with
+# isdir; anything else (e.g. paths longer than MAX_PATH) goes through os.makedirs,
+# which raises the proper error. SHCreateDirectoryExW sends a shell change
+# notification per folder, so it is only used for the few top-level subfolders.
+def make_dirs(path):
+  if os.name == 'nt' and shell32.SHCreateDirectoryExW(None, os.path.abspath(path), None) in CREATE_DIRECTORY_OK and os.path.isdir(path):
+    return
+  os.makedirs(path, exist_ok=True)
+
+# Copy a folder tree. On Windows, robocopy's multithreaded copy engine is much
+# faster than shutil.copytree for folders with many binaries.
+def fast_copytree(src, dst):
+  if os.name == 'nt' and shutil.which("robocopy"):
+    result = subprocess.run(["robocopy", src, dst, "/E", "/MT:16", "/R:1", "/W:1", "/NFL", "/NDL", "/NJH", "/NJS"])
+    # robocopy return codes below 8 mean success (0 = nothing copied, 1 = files copied, ...)
+    if result.returncode >= 8:
+      raise OSError(f"robocopy failed with exit code {result.returncode} copying {src} to {dst}")
+  else:
+    shutil.copytree(src, dst, copy_function=copy_file)
+
+# Make files writable before deleting (Windows permission issue)
+def make_writable(func, path, exc_info):
+  os.chmod(path, 0o777)
+  func(path)
+
+# cmd parses these even in a path, and subprocess only quotes paths with
+# spaces (and % expands even inside quotes), so such paths never go through cmd
+CMD_SPECIAL_CHARACTERS = set('&|<>()^%!"')
+
+# Delete a folder tree. On Windows, rd /s /q deletes the whole tree in one
+# native process, which is much faster than shutil.rmtree for large packages.
+# rd skips read-only files, so those are made writable and deleted in a second pass.
+# Paths containing cmd special characters are deleted with shutil.rmtree instead.
+# Raises FileNotFoundError if the folder does not exist.
+def remove_tree(path, ignore_errors=False):
+  try:
+    if os.name == 'nt' and not CMD_SPECIAL_CHARACTERS.intersection(path):
+      if not os.path.isdir(path):
+        raise FileNotFoundError(f"Folder not found: {path}")
+      removeCommand = ["cmd", "/c", "rd", "/s", "/q", path]
+      subprocess.run(removeCommand, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      if os.path.exists(path):
+        subprocess.run(["attrib", "-R", os.path.join(path, "*"), "/S", "/D"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(removeCommand, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if os.path.exists(path):
+          raise OSError(f"Could not remove {path}")
+    else:
+      shutil.rmtree(path, onerror=make_writable)
+  except OSError:
+    if not ignore_errors:
+      raise
+
+# Walk a folder tree once and return the relative paths of its folders and
+# files, so several copies of the same tree do not each walk it again
+def list_tree(root):
+  folders = []
+  files = []
+  for folder, folderNames, fileNames in os.walk(root):
+    relFolder = os.path.relpath(folder, root)
+    folders.append(relFolder)
+    files.extend(os.path.join(relFolder, name) for name in fileNames)
+  return folders, files
+
+# Copy a folder tree listed by list_tree, creating all folders first and then
+# copying the files in parallel. Every deployed package gets its own copy of
+# the files: hard links would let one Dynamo host's loaded or edited files
+# block or change the other host's package.
+def copy_listed_tree(src, dst, tree):
+  folders, files = tree
+
+  def copy_listed_file(relPath):
+    copy_file(os.path.join(src, relPath), os.path.join(dst, relPath))
+
+  for folder in folders:
+    os.makedirs(os.path.join(dst, folder), exist_ok=True)
+
+  with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+    list(executor.map(copy_listed_file, files))
+
+# True if both paths exist and are the same folder, e.g. through a junction or symlink
+def is_same_folder(path, otherPath):
+  try:
+    return os.path.samefile(path, otherPath)
+  except OSError:
+    return False
+
+# Hash of the package inputs, stored next to each deployed package so an
+# unchanged package does not need to be deployed again
+BUILD_HASH_FILE = ".build_hash"
+
+# Hash the relative path, size and modification time of every file under the
+# given folders (or of the given files) together with the extra values
+def compute_build_hash(paths, *values):
+  lines = list(values)
+
+  def add_entries(folder, relFolder):
+    with os.scandir(folder) as entries:
+      for entry in sorted(entries, key=lambda e: e.name):
+        relPath = relFolder + "/" + entry.name
+        if entry.is_dir(follow_symlinks=False):
+          add_entries(entry.path, relPath)
+        else:
+          stat = entry.stat(follow_symlinks=False)
+          lines.append(f"{relPath}\0{stat.st_size}\0{stat.st_mtime_ns}")
+
+  for index, path in enumerate(paths):
+    if os.path.isdir(path):
+      add_entries(path, str(index))
+    elif os.path.isfile(path):
+      stat = os.stat(path)
+      lines.append(f"{index}\0{stat.st_size}\0{stat.st_mtime_ns}")
+    else:
+      lines.append(f"{index}\0missing")
+
+  return hashlib.blake2b("\n".join(lines).encode()).hexdigest()
+
+def read_build_hash(folder):
+  try:
+    with open(os.path.join(folder, BUILD_HASH_FILE), 'r') as file:
+      return file.read().strip()
+  except OSError:
+    return None
+
+# Write the hash through a temporary file so a partial write is never read back
+def write_build_hash(folder, buildHash):
+  hashPath = os.path.join(folder, BUILD_HASH_FILE)
+  with open(hashPath + ".tmp", 'w') as file:
+    file.write(buildHash)
+  os.replace(hashPath + ".tmp", hashPath)
 
 def main():
 
@@ -20,56 +217,54 @@ def main():
   templateFolder = os.path.join(currentFolder, "package-template")
   targetFolder = os.path.join(currentFolder, "..", "dynamo-package")
 
-  if (os.path.exists(targetFolder)):
-    try:
-      # Make files writable before deleting (Windows permission issue)
-      def make_writable(func, path, exc_info):
-        os.chmod(path, 0o777)
-        func(path)
-      
-      shutil.rmtree(targetFolder, onerror=make_writable)
-    except Exception as e:
-      print(f"Warning: Could not remove existing dynamo-package folder: {e}")
-      print("Attempting to continue anyway...")
+  try:
+    remove_tree(targetFolder)
+  except FileNotFoundError:
+    pass  # Nothing to remove on a first build
+  except Exception as e:
+    print(f"Warning: Could not remove existing dynamo-package folder: {e}")
+    print("Attempting to continue anyway...")
 
   # The actual build output is in bin\Config\DynamoVersion\DataExchangeNodes
   sourceBinariesFolder = os.path.join(currentFolder, "..", "bin", config, dynamoVersion, "DataExchangeNodes")
 
-  if not (os.path.exists(sourceBinariesFolder) and 
-          os.path.exists(templateFolder)):
+  try:
+    os.stat(sourceBinariesFolder)
+    os.stat(templateFolder)
+  except OSError:
     print("Incomplete build.")
     print(f"Expected build output at: {sourceBinariesFolder}")
     print(f"Template folder: {templateFolder}")
     print("Build may not have completed successfully, or output path is different.")
     sys.exit(1)  # Exit with error code so MSBuild knows the step failed
 
-  shutil.copytree(templateFolder, targetFolder)
+  fast_copytree(templateFolder, targetFolder)
   targetFolderBin = os.path.join(targetFolder, "bin")
   targetFolderDyf = os.path.join(targetFolder, "dyf")
   targetFolderExtra = os.path.join(targetFolder, "extra")
 
-  os.makedirs(targetFolderBin, exist_ok=True)
-  os.makedirs(targetFolderDyf, exist_ok=True)
-  os.makedirs(targetFolderExtra, exist_ok=True)
-
-  # Check if pkg.json exists in template
-  pkgJsonPath = os.path.join(targetFolder, "pkg.json")
-  if not os.path.exists(pkgJsonPath):
-    print("Incomplete build. Missing pkg.json in template")
-    return
+  for packageSubfolder in (targetFolderBin, targetFolderDyf, targetFolderExtra):
+    make_dirs(packageSubfolder)
 
   # Read version from project (we'll use the template version for now)
   # In the future, this could read from the built assembly
   packageVersion = "0.1.0"
 
-  # Replace placeholders in template pkg.json
-  with open(pkgJsonPath, 'r') as file:
-    pkgJsonContent = file.read()
-    pkgJsonContent = pkgJsonContent.replace('$Version$', packageVersion)
-    pkgJsonContent = pkgJsonContent.replace('$DynamoVersion$', dynamoInstallVersion)
-
-  with open(pkgJsonPath, 'w') as file:
-    file.write(pkgJsonContent)
+  # Replace placeholders in template pkg.json in a single pass, reading and
+  # writing through one file handle. Nothing is written if there is nothing to replace.
+  pkgJsonPath = os.path.join(targetFolder, "pkg.json")
+  placeholders = {'Version': packageVersion, 'DynamoVersion': dynamoInstallVersion}
+  try:
+    with open(pkgJsonPath, 'r+', encoding='utf-8') as file:
+      pkgJsonTemplate = file.read()
+      pkgJsonContent = re.sub(r'\$(Version|DynamoVersion)\$', lambda match: placeholders[match.group(1)], pkgJsonTemplate)
+      if pkgJsonContent != pkgJsonTemplate:
+        file.seek(0)
+        file.write(pkgJsonContent)
+        file.truncate()
+  except FileNotFoundError:
+    print("Incomplete build. Missing pkg.json in template")
+    return
 
   print(f"Package version set to: {packageVersion}")
 
@@ -78,18 +273,21 @@ def main():
   # Exclude win-x64 folder (it's a duplicate build artifact)
   excludedFromBin = ["RootDir", "libg_231_0_0", "win-x64"]
   
-  for item in os.listdir(sourceBinariesFolder):
-    if item in excludedFromBin:
-      continue  # Skip these - they'll be handled separately
-    
-    source_item = os.path.join(sourceBinariesFolder, item)
-    target_item = os.path.join(targetFolderBin, item)
-    if os.path.isfile(source_item):
-      shutil.copy2(source_item, targetFolderBin)
-    elif os.path.isdir(source_item):
-      if os.path.exists(target_item):
-        shutil.rmtree(target_item)
-      shutil.copytree(source_item, target_item)
+  # DirEntry caches the file type from the directory listing, so no extra stat per item
+  def copy_to_bin(entry):
+    target_item = os.path.join(targetFolderBin, entry.name)
+    if entry.is_file(follow_symlinks=False):
+      # DirEntry.stat() is cached on Windows, where the size is used
+      copy_file(entry.path, target_item, entry.stat(follow_symlinks=False).st_size)
+    elif entry.is_dir(follow_symlinks=False):
+      remove_tree(target_item, ignore_errors=True)
+      shutil.copytree(entry.path, target_item, copy_function=copy_file)
+
+  # Skip excluded items - they'll be handled separately
+  with os.scandir(sourceBinariesFolder) as entries:
+    binItems = [entry for entry in entries if entry.name not in excludedFromBin]
+  with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+    list(executor.map(copy_to_bin, binItems))
   
   # Copy RootDir and libg_231_0_0 folders to package root (if they exist in build output)
   # These folders should be in the build output (bin/Config/Version/DataExchangeNodes/)
@@ -102,76 +300,125 @@ def main():
   rootDirSourceAlt = os.path.join(libgFolderRoot, "RootDir")
   libgDirSourceAlt = os.path.join(libgFolderRoot, "libg_231_0_0")
   
+  # Copy a folder to the package root from the first source that exists
+  def copy_to_root(folderName, sources):
+    target = os.path.join(targetFolder, folderName)
+    for source, origin in sources:
+      remove_tree(target, ignore_errors=True)
+      try:
+        shutil.copytree(source, target, copy_function=copy_file)
+      except FileNotFoundError:
+        continue
+      print(f"Copied {folderName} from {origin} to package")
+      return
+    print(f"Warning: {folderName} folder not found. Expected at: {' or '.join(source for source, origin in sources)}")
+
   # Copy RootDir folder
-  rootDirTarget = os.path.join(targetFolder, "RootDir")
-  if os.path.exists(rootDirSource):
-    if os.path.exists(rootDirTarget):
-      shutil.rmtree(rootDirTarget)
-    shutil.copytree(rootDirSource, rootDirTarget)
-    print(f"Copied RootDir from build output to package")
-  elif os.path.exists(rootDirSourceAlt):
-    if os.path.exists(rootDirTarget):
-      shutil.rmtree(rootDirTarget)
-    shutil.copytree(rootDirSourceAlt, rootDirTarget)
-    print(f"Copied RootDir from libg folder to package")
-  else:
-    print(f"Warning: RootDir folder not found. Expected at: {rootDirSource} or {rootDirSourceAlt}")
-  
+  copy_to_root("RootDir", [(rootDirSource, "build output"), (rootDirSourceAlt, "libg folder")])
+
   # Copy libg_231_0_0 folder
-  libgDirTarget = os.path.join(targetFolder, "libg_231_0_0")
-  if os.path.exists(libgDirSource):
-    if os.path.exists(libgDirTarget):
-      shutil.rmtree(libgDirTarget)
-    shutil.copytree(libgDirSource, libgDirTarget)
-    print(f"Copied libg_231_0_0 from build output to package")
-  elif os.path.exists(libgDirSourceAlt):
-    if os.path.exists(libgDirTarget):
-      shutil.rmtree(libgDirTarget)
-    shutil.copytree(libgDirSourceAlt, libgDirTarget)
-    print(f"Copied libg_231_0_0 from libg folder to package")
-  else:
-    print(f"Warning: libg_231_0_0 folder not found. Expected at: {libgDirSource} or {libgDirSourceAlt}")
+  copy_to_root("libg_231_0_0", [(libgDirSource, "build output"), (libgDirSourceAlt, "libg folder")])
 
-  # Helper function to make files writable before deletion (Windows permission issue)
-  def make_writable(func, path, exc_info):
-    try:
-      os.chmod(path, 0o777)
-      func(path)
-    except:
-      pass  # Ignore errors during cleanup
+  # Hash everything the package is built from: template, build output, libg
+  # fallback folder, this script and its arguments. If a deployed package
+  # carries the same hash it is already up to date and is left untouched.
+  buildHash = compute_build_hash([templateFolder, sourceBinariesFolder, libgFolderRoot, os.path.realpath(__file__)], *sys.argv[1:])
 
   # Deploy to Dynamo package folders (use install version like 4.1, not full version like 4.1.0-beta3200)
-  packageTargetFolder = os.path.join(os.getenv("APPDATA"), "Dynamo", "Dynamo Core", dynamoInstallVersion, "packages", "DataExchangeNodes")
+  appDataFolder = os.getenv("APPDATA")
 
-  if os.path.exists(packageTargetFolder):
-    try:
-      shutil.rmtree(packageTargetFolder, onerror=make_writable)
-    except Exception as e:
-      print(f"Warning: Could not remove existing package folder {packageTargetFolder}: {e}")
-      print("This may be because Dynamo is running. The package will be updated in place.")
+  def package_folder(dynamoFlavor):
+    return os.path.join(appDataFolder, "Dynamo", dynamoFlavor, dynamoInstallVersion, "packages", "DataExchangeNodes")
 
-  try:
-    shutil.copytree(targetFolder, packageTargetFolder)
-    print("Dynamo package complete  " + packageTargetFolder)
-  except Exception as e:
-    print(f"Error copying to {packageTargetFolder}: {e}")
-    print("Make sure Dynamo is not running and try again.")
+  packageTargetFolder = package_folder("Dynamo Core")
 
   # Also copy to Dynamo Revit
-  packageTargetFolderRevit = os.path.join(os.getenv("APPDATA"), "Dynamo", "Dynamo Revit", dynamoInstallVersion, "packages", "DataExchangeNodes")
+  packageTargetFolderRevit = package_folder("Dynamo Revit")
+
+  # Folders of replaced packages, deleted in the background once the new package is in place
+  cleanupThreads = []
+
+  # Build the new package next to the deployed one, on the same volume, then
+  # swap it in with two renames. The live package is never left half deleted
+  # or half copied.
+  def deploy(packageFolder, applicationName):
+    # Names are unique per run, so a leftover of an earlier run that could not be
+    # deleted (e.g. a file still held open) never blocks this deploy
+    stagingFolder = f"{packageFolder}.new.{os.getpid()}"
+    oldFolder = f"{packageFolder}.old.{os.getpid()}"
 
-  if os.path.exists(packageTargetFolderRevit):
     try:
-      shutil.rmtree(packageTargetFolderRevit, onerror=make_writable)
+      copy_listed_tree(targetFolder, stagingFolder, packageTree)
+      write_build_hash(stagingFolder, buildHash)
     except Exception as e:
-      print(f"Warning: Could not remove existing Revit package folder {packageTargetFolderRevit}: {e}")
+      remove_tree(stagingFolder, ignore_errors=True)
+      log(f"Error copying to {stagingFolder}: {e}")
+      return
 
-  try:
-    shutil.copytree(targetFolder, packageTargetFolderRevit)
-    print("Dynamo package complete  " + packageTargetFolderRevit)
-  except Exception as e:
-    print(f"Error copying to {packageTargetFolderRevit}: {e}")
-    print("Make sure Dynamo Revit is not running and try again.")
+    try:
+      os.rename(packageFolder, oldFolder)
+    except FileNotFoundError:
+      pass  # Not deployed yet
+    except OSError as e:
+      remove_tree(stagingFolder, ignore_errors=True)
+      log(f"Error: Could not replace existing package folder {packageFolder}: {e}\n"
+          f"Make sure {applicationName} is not running and try again.")
+      return
+
+    try:
+      os.rename(stagingFolder, packageFolder)
+    except OSError as e:
+      remove_tree(stagingFolder, ignore_errors=True)
+      log(f"Error: Could not replace existing package folder {packageFolder}: {e}\n"
+          f"Make sure {applicationName} is not running and try again.")
+      # Put the previous package back, if there was one
+      try:
+        os.rename(oldFolder, packageFolder)
+      except FileNotFoundError:
+        pass
+      except OSError as restoreError:
+        log(f"Error: Could not restore the previous package: {restoreError}\n"
+            f"It was left in {oldFolder}. Rename it to {os.path.basename(packageFolder)} to use it again.")
+      return
+
+    log("Dynamo package complete  " + packageFolder)
+
+    # Delete the replaced package and any leftovers of earlier runs, so Dynamo
+    # does not find them as packages. This only happens once the new package is
+    # in place, so a previous package left behind by a failed run is kept until then.
+    # Best effort: whatever cannot be deleted yet is retried by the next deploy.
+    def remove_leftovers():
+      for leftoverFolder in glob.glob(glob.escape(packageFolder) + ".new.*") + glob.glob(glob.escape(packageFolder) + ".old.*"):
+        remove_tree(leftoverFolder, ignore_errors=True)
+
+    # Not a daemon thread, so the cleanup finishes before the script exits
+    cleanupThread = threading.Thread(target=remove_leftovers)
+    cleanupThread.start()
+    cleanupThreads.append(cleanupThread)
+
+  outdatedPackages = []
+  for packageFolder, applicationName in [(packageTargetFolder, "Dynamo"), (packageTargetFolderRevit, "Dynamo Revit")]:
+    # A package folder linked to dynamo-package was already rebuilt in place.
+    # One linked to the other package folder must not be deployed twice at once.
+    if is_same_folder(packageFolder, targetFolder):
+      print("Dynamo package is linked to dynamo-package  " + packageFolder)
+    elif any(is_same_folder(packageFolder, outdatedFolder) for outdatedFolder, _ in outdatedPackages):
+      print("Dynamo package is linked to another package folder  " + packageFolder)
+    elif read_build_hash(packageFolder) == buildHash:
+      print("Dynamo package is up to date  " + packageFolder)
+    else:
+      outdatedPackages.append((packageFolder, applicationName))
+
+  if outdatedPackages:
+    # Both deploys are copies of the same tree, so walk it only once
+    packageTree = list_tree(targetFolder)
+
+    # The two package folders are independent, so stage and swap them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      list(executor.map(deploy, *zip(*outdatedPackages)))
+
+  for cleanupThread in cleanupThreads:
+    cleanupThread.join()
 
 if __name__ == "__main__":
   main()